@@ -52,7 +52,8 @@ def initialize_databases(engine: Engine) -> None:
 
 
 def get_missing_isrc(engine: Engine) -> list[str]:
-    """ Returns a list containing ISRC of songs in the spotify table that is neither in the acousticbrainz table, nor has it unsuccessfully been used to fetch MBIDs. """
+    """ Returns a list containing ISRC of songs in the spotify table that is neither in the acousticbrainz table, nor has it unsuccessfully been used to fetch MBIDs.
+        The spotify table is shared by all accounts, so an ISRC played by several accounts is only returned, and resolved, once. """
     with engine.begin() as conn:
         query = text(""" 
                 SELECT DISTINCT s.isrc 
@@ -1,5 +1,26 @@
-from http.server import BaseHTTPRequestHandler, HTTPServer
+from http.server import BaseHTTPRequestHandler, HTTPServer, ThreadingHTTPServer
+from collections import OrderedDict
+from datetime import datetime
+from typing import Optional
 import urllib.parse
+import hashlib
+import json
+import os
+import threading
+from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import SQLAlchemyError
+import pandas as pd
+from pandas.errors import DatabaseError
+
+import sql_operations
+
+AUTHORIZATION_TIMEOUT = 300        # seconds to wait for the OAuth redirect
+CACHE_MAX_BYTES = 64 * 1024 ** 2   # total size of cached response bodies
+MAX_PAGE_SIZE = 10_000             # max rows per page of the large table
+PROBABILITY_DECIMALS = 6           # float32 probabilities are exact to about 7 digits
+# pd.read_sql wraps SQLAlchemy errors in its own DatabaseError
+DATABASE_ERRORS = (SQLAlchemyError, DatabaseError)
 
 
 class RedirectHandler(BaseHTTPRequestHandler):
@@ -24,8 +45,223 @@ class RedirectHandler(BaseHTTPRequestHandler):
             self.wfile.write(b"Authorization failed. No code found.")
 
 
-def run_server(server_address):
+def run_server(server_address, timeout: float = AUTHORIZATION_TIMEOUT):
     httpd = HTTPServer(server_address, RedirectHandler)
+    httpd.timeout = timeout
     print(f"Server running at {server_address}")
-    httpd.handle_request()  # Handle one request and then stop
-    return httpd.authorization_code
+    try:
+        httpd.handle_request()  # Handle one request and then stop, or give up after the timeout
+    finally:
+        httpd.server_close()
+    return getattr(httpd, "authorization_code", None)
+
+
+class ResponseCache:
+    """ Thread-safe LRU cache of rendered responses, keyed by request path and limited by the total size of the bodies. Entries are
+        (etag, content type, body). The cache is cleared whenever the version of the database changes, i.e. when the pipeline commits new rows. """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.entries = OrderedDict()
+        self.version = None
+        self.lock = threading.Lock()
+
+    def validate(self, version) -> None:
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.size = 0
+                self.version = version
+
+    def get(self, key: str) -> Optional[tuple[str, str, bytes]]:
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, entry: tuple[str, str, bytes], version) -> None:
+        """ Cache an entry rendered against the given database version. Entries rendered against an outdated version, or larger than the whole cache,
+            are dropped. """
+        body_size = len(entry[2])
+        with self.lock:
+            if version != self.version or body_size > self.max_bytes:
+                return
+            old_entry = self.entries.pop(key, None)
+            if old_entry is not None:
+                self.size -= len(old_entry[2])
+            self.entries[key] = entry
+            self.size += body_size
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted[2])
+
+
+def prepare_frame(df: pd.DataFrame) -> pd.DataFrame:
+    """ Undo the compact dtypes of the raw_data loader for output, the same way for every format: played_at as ISO-8601 UTC like Spotify reports it,
+        and probabilities back in double precision, rounded so float32 noise doesn't show. """
+    if "played_at" in df.columns:
+        df["played_at"] = df["played_at"].dt.strftime("%Y-%m-%dT%H:%M:%S.%f").str[:-3] + "Z"
+    for col in sql_operations.FLOAT32_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype("float64").round(PROBABILITY_DECIMALS)
+    return df
+
+
+class QueryServer(ThreadingHTTPServer):
+    """ Threaded HTTP server holding the database engine and response cache shared by all request handlers. """
+    daemon_threads = True
+
+    def __init__(self, server_address, db_loc: str):
+        url = make_url(db_loc)
+        if url.get_backend_name() != "sqlite" or url.database in (None, "", ":memory:"):
+            raise ValueError(f"The query server needs a SQLite database file, got {db_loc}.")
+        super().__init__(server_address, QueryHandler)
+        self.engine = create_engine(db_loc)
+        sql_operations.migrate_to_accounts(self.engine)
+        self.db_path = url.database
+        self.cache = ResponseCache()
+
+    def data_version(self) -> tuple:
+        """ Version of the database, taken from the modification time and size of the database file (and its write-ahead log, if any). Every commit
+            changes it, and checking it doesn't require a query. Two commits within one tick of the filesystem clock that leave the file size unchanged
+            can't be told apart, the second is picked up with the next commit. """
+        version = []
+        for path in (self.db_path, f"{self.db_path}-wal"):
+            try:
+                stat = os.stat(path)
+                version.append((stat.st_mtime_ns, stat.st_size))
+            except OSError:
+                version.append(None)
+        return tuple(version)
+
+    def server_close(self):
+        super().server_close()
+        self.engine.dispose()
+
+
+class QueryHandler(BaseHTTPRequestHandler):
+    """ Read-only query API for Power BI.
+        GET /hourly                                 hourly aggregate as JSON
+        GET /large?page=1&page_size=1000            one page of the large table as JSON
+        GET /large?format=ndjson|csv                the whole large table, streamed
+        GET /date/YYYY-MM-DD                        all plays of one date as JSON """
+
+    def do_GET(self):
+        parsed = urllib.parse.urlparse(self.path)
+        params = urllib.parse.parse_qs(parsed.query)
+        path = parsed.path.rstrip("/")
+        version = self.server.data_version()
+        self.server.cache.validate(version)
+
+        try:
+            output_format = params.get("format", ["json"])[0]
+            if path == "/large" and output_format not in ("json", "ndjson", "csv"):
+                raise ValueError(f"Unknown format {output_format}, use json, ndjson or csv.")
+
+            if path == "/hourly":
+                self.send_cached(self.path, version, self.render_hourly)
+            elif path == "/large" and output_format in ("ndjson", "csv"):
+                self.send_stream(output_format, version)
+            elif path == "/large":
+                page = int(params.get("page", ["1"])[0])
+                page_size = int(params.get("page_size", ["1000"])[0])
+                if page < 1 or not 1 <= page_size <= MAX_PAGE_SIZE:
+                    raise ValueError(f"page must be at least 1 and page_size between 1 and {MAX_PAGE_SIZE}.")
+                self.send_cached(self.path, version, lambda: self.render_page(page, page_size))
+            elif path.startswith("/date/"):
+                date = datetime.strptime(path[len("/date/"):], "%Y-%m-%d").strftime("%Y-%m-%d")
+                self.send_cached(self.path, version, lambda: self.render_date(date))
+            else:
+                self.send_error(404, "Unknown endpoint.")
+        except ValueError as e:
+            self.send_error(400, str(e))
+        except DATABASE_ERRORS as e:
+            self.log_error("Database error: %s", e)
+            self.send_error(500, "Database error.")
+
+    def send_cached(self, key: str, version: tuple, render) -> None:
+        """ Send a response from the cache, rendering and caching it first if needed. Answers 304 if the client already has the current version. """
+        entry = self.server.cache.get(key)
+        if entry is None:
+            content_type, body = render()
+            etag = f'"{hashlib.sha1(body).hexdigest()}"'
+            entry = (etag, content_type, body)
+            self.server.cache.put(key, entry, version)
+
+        etag, content_type, body = entry
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_stream(self, output_format: str, version: tuple) -> None:
+        """ Stream the large table chunk by chunk. Too large to cache, so the ETag is derived from the database version instead of the body. """
+        etag = f'W/"{hashlib.sha1(repr((output_format, version)).encode()).hexdigest()}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+
+        with self.server.engine.connect() as conn:
+            # read the first chunk before sending headers, so database errors can still be answered with a 500
+            chunks = sql_operations.iter_raw_data(conn)
+            chunk = next(chunks, None)
+
+            self.send_response(200)
+            self.send_header("Content-type", "application/x-ndjson" if output_format == "ndjson" else "text/csv")
+            self.send_header("ETag", etag)
+            self.end_headers()
+
+            first = True
+            try:
+                while chunk is not None:
+                    chunk = prepare_frame(chunk)
+                    if output_format == "ndjson":
+                        self.wfile.write(chunk.to_json(orient="records", lines=True).encode())
+                    else:
+                        self.wfile.write(chunk.to_csv(index=False, header=first).encode())
+                    first = False
+                    chunk = next(chunks, None)
+            except DATABASE_ERRORS as e:
+                # headers are already sent, all that can be done is cutting the response short
+                self.log_error("Database error while streaming: %s", e)
+                self.close_connection = True
+
+    def render_hourly(self) -> tuple[str, bytes]:
+        with self.server.engine.connect() as conn:
+            df = sql_operations.hourly_data(conn, verbose=False)
+        return "application/json", df.to_json(orient="records").encode()
+
+    def render_page(self, page: int, page_size: int) -> tuple[str, bytes]:
+        with self.server.engine.connect() as conn:
+            df = sql_operations.load_raw_data(conn, limit=page_size, offset=(page - 1) * page_size, verbose=False)
+        rows = json.loads(prepare_frame(df).to_json(orient="records"))
+        return "application/json", json.dumps({"page": page, "page_size": page_size, "rows": rows}).encode()
+
+    def render_date(self, date: str) -> tuple[str, bytes]:
+        with self.server.engine.connect() as conn:
+            df = sql_operations.load_raw_data(conn, where="date = :date", params={"date": date}, verbose=False)
+        return "application/json", prepare_frame(df).to_json(orient="records").encode()
+
+
+def run_query_server(db_loc: str, server_address) -> None:
+    """ Serve the database read-only over HTTP until interrupted. """
+    httpd = QueryServer(server_address, db_loc)
+    print(f"Query server running at {server_address}")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
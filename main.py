@@ -1,8 +1,12 @@
 import spotify_extraction
+import localserver
 import acousticbrainz_extraction
 import sql_operations
+import os
 
 DATABASE_LOCATION = "sqlite:///my_tracks.sqlite"
+ACCOUNTS_DIRECTORY = "./accounts"  # one subdirectory per account enables multi-account mode
+QUERY_SERVER_ADDRESS = ("localhost", 8000)
 
 if __name__ == "__main__":
 
@@ -16,8 +20,11 @@ if __name__ == "__main__":
 
     if ans in ["YES", "Y"]:
         # run spotify extraction
-        spotify_extraction.run(DATABASE_LOCATION)
-        # perform further metadata extractions
+        if os.path.isdir(ACCOUNTS_DIRECTORY):
+            spotify_extraction.run_accounts(DATABASE_LOCATION, ACCOUNTS_DIRECTORY)
+        else:
+            spotify_extraction.run(DATABASE_LOCATION)
+        # perform further metadata extractions, once for all accounts
         acousticbrainz_extraction.run(DATABASE_LOCATION)
         # combine into large table containing all raw data.
         sql_operations.run(DATABASE_LOCATION)
@@ -33,3 +40,14 @@ if __name__ == "__main__":
     if ans2 in ["YES", "Y"]:
         sql_operations.create_hourly_sheet(DATABASE_LOCATION, "./exports")
         sql_operations.create_large_sheet(DATABASE_LOCATION, "./exports")
+
+    while True:
+        ans3 = input("Do you want to serve the data over HTTP for Power BI? Answer with Yes/y or No/n: ").upper()
+
+        if ans3 in ["YES", "Y", "NO", "N"]:
+            break
+        else:
+            print("Invalid input. Answer with yes/y or no/n.")
+
+    if ans3 in ["YES", "Y"]:
+        localserver.run_query_server(DATABASE_LOCATION, QUERY_SERVER_ADDRESS)
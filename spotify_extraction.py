@@ -7,23 +7,32 @@ import datetime
 import spotipy
 from spotipy.oauth2 import SpotifyOAuth
 from urllib.parse import urlparse
-from typing import Any
+from typing import Any, Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import os
 import webbrowser
 
 import localserver
+import sql_operations
 
+CONFIG_PATH = "spotify_config.txt"
+TOKEN_CACHE_NAME = ".spotify_token_cache.json"
 
-def establish_spotify_connection() -> spotipy.Spotify:
-    """ Establish connection to Spotify. Uses client id and secret to generate token from local server. """
 
-    with open("spotify_config.txt", "r") as file:
+def establish_spotify_connection(config_path: str = CONFIG_PATH, token_cache_path: str = TOKEN_CACHE_NAME, headless: bool = False,
+                                 authorize: bool = True) -> spotipy.Spotify:
+    """ Establish connection to Spotify. Uses client id and secret to generate token from local server. In headless mode the authorization
+        link is printed instead of opened in a browser, so it can be opened on any device that can reach the redirect URI. Without authorize,
+        only cached tokens are used and a missing token raises instead of waiting for the redirect. """
+
+    with open(config_path, "r") as file:
         lines = file.read().splitlines()
         client_id = lines[0]
         client_secret = lines[1]
         redirect_uri = lines[2]
 
     # check for cached access/refresh tokens. If none are found, authorize using link
-    token_cache_path = ".spotify_token_cache.json"
     auth_manager = SpotifyOAuth(client_id=client_id,
                                 client_secret=client_secret,
                                 redirect_uri=redirect_uri,
@@ -32,9 +41,15 @@ def establish_spotify_connection() -> spotipy.Spotify:
 
     token_info = auth_manager.get_cached_token()
 
+    if not token_info and not authorize:
+        raise RuntimeError(f"No cached token found in {token_cache_path}, the account has to be bootstrapped first.")
+
     if not token_info:
         auth_url = auth_manager.get_authorize_url()
-        webbrowser.open(auth_url)
+        if headless:
+            print(f"Open the following link to authorize access to Spotify: {auth_url}")
+        else:
+            webbrowser.open(auth_url)
 
         # local server to handle redirect
         parsed_uri = urlparse(redirect_uri)
@@ -147,24 +162,8 @@ def get_database_tracks(engine) -> dict[str, dict[str, str]]:
 def initialize_database(engine: Engine) -> None:
     """ Initialize database if it doesn't exist. Needed for first run. """
     with engine.begin() as conn:
-        query = text("""
-            CREATE TABLE IF NOT EXISTS raw_spotify_data (       
-                played_at TEXT PRIMARY KEY,         -- timestamp of when song was played
-                date TEXT,                          -- date of when song was played
-                song_name TEXT,                     -- song name
-                main_artist TEXT,                   -- name of artist
-                featured_artists TEXT,              -- names of featured artists, if any
-                album_name TEXT,                    -- name of song album
-                artist_genre TEXT,                         -- artist genre
-                release_date TEXT,                  -- song release date
-                duration_sec INTEGER,               -- song length
-                track_id TEXT,                      -- spotify song id
-                artist_id TEXT,                     -- spotify artist id
-                spotify_url TEXT,                   -- spotify song url
-                isrc TEXT                           -- International Standard Recording Code
-                )
-                       """)
-        conn.execute(query)
+        conn.execute(text(sql_operations.RAW_SPOTIFY_DATA_SCHEMA))
+    sql_operations.migrate_to_accounts(engine)
 
 
 def upload_data(df: pd.DataFrame, engine: Engine) -> None:
@@ -175,8 +174,9 @@ def upload_data(df: pd.DataFrame, engine: Engine) -> None:
 
     try:
         with engine.begin() as conn:
-            query = text("SELECT played_at FROM raw_spotify_data ORDER BY played_at DESC LIMIT 1")
-            latest_uploaded_timestamp = conn.execute(query).scalar()
+            account = df['account'].iloc[0]
+            query = text("SELECT played_at FROM raw_spotify_data WHERE account = :account ORDER BY played_at DESC LIMIT 1")
+            latest_uploaded_timestamp = conn.execute(query, {"account": account}).scalar()
 
             df['datetime'] = pd.to_datetime(df['played_at'])
 
@@ -185,7 +185,7 @@ def upload_data(df: pd.DataFrame, engine: Engine) -> None:
                 latest_uploaded_timestamp_datetime = pd.to_datetime(latest_uploaded_timestamp)
                 new_data = df[df['datetime'] > latest_uploaded_timestamp_datetime]
                 print(
-                    f"DataFrame filtered. Out of {len(df.index)}, {len(new_data.index)} songs were played after {latest_uploaded_timestamp_datetime} and will be uploaded to the database.")
+                    f"DataFrame filtered. Out of {len(df.index)}, {len(new_data.index)} songs of account {account} were played after {latest_uploaded_timestamp_datetime} and will be uploaded to the database.")
             else:
                 new_data = df
 
@@ -197,7 +197,7 @@ def upload_data(df: pd.DataFrame, engine: Engine) -> None:
                 return
 
             new_data.drop('datetime', axis=1).to_sql('raw_spotify_data', engine, index=False, if_exists='append')
-            print(f"Data loaded successfully. {len(new_data.index)} songs were uploaded, played between {new_data.iloc[0]["played_at"]} and {new_data.iloc[-1]["played_at"]}.")
+            print(f"Data loaded successfully. {len(new_data.index)} songs were uploaded, played between {new_data.iloc[0]['played_at']} and {new_data.iloc[-1]['played_at']}.")
     except Exception as e:
         print(f"failed to upload to database. Error : {e}")
 
@@ -214,7 +214,7 @@ def validate_data(df: pd.DataFrame) -> bool:
     #    raise Exception("DataFrame contains null values")
 
     # primary key constraint
-    if pd.Series(df['played_at']).is_unique:
+    if not df.duplicated(subset=['account', 'played_at']).any():
         pass
     else:
         raise Exception("Primary key is not unique")
@@ -222,6 +222,50 @@ def validate_data(df: pd.DataFrame) -> bool:
     return True
 
 
+def get_account_paths(accounts_directory: str, account: str) -> tuple[str, str]:
+    """ Returns the config and token cache paths of an account. Every account has its own OAuth token cache, the config falls back to the shared
+        spotify_config.txt when the account directory doesn't contain one. """
+    account_directory = os.path.join(accounts_directory, account)
+    config_path = os.path.join(account_directory, CONFIG_PATH)
+    if not os.path.isfile(config_path):
+        config_path = CONFIG_PATH
+    token_cache_path = os.path.join(account_directory, TOKEN_CACHE_NAME)
+    return config_path, token_cache_path
+
+
+def list_accounts(accounts_directory: str) -> list[str]:
+    """ Returns the names of all accounts, one subdirectory of the accounts directory per account. """
+    return sorted(entry.name for entry in os.scandir(accounts_directory) if entry.is_dir())
+
+
+def bootstrap_account(accounts_directory: str, account: str) -> None:
+    """ Creates the account directory and authorizes the account headlessly, caching its tokens for later unattended runs. """
+    os.makedirs(os.path.join(accounts_directory, account), exist_ok=True)
+    config_path, token_cache_path = get_account_paths(accounts_directory, account)
+    print(f"Bootstrapping Spotify account {account}.")
+    establish_spotify_connection(config_path, token_cache_path, headless=True)
+
+
+def ingest(engine: Engine, sp: spotipy.Spotify, account: str = sql_operations.DEFAULT_ACCOUNT, upload_lock: Optional[threading.Lock] = None) -> None:
+    """ Fetches and processes the recently played songs of one account and uploads them to the database. Uploads are serialized through
+        upload_lock when accounts are ingested concurrently, since SQLite only allows a single writer. """
+    recently_played_tracks = extract_spotify_data(sp)
+    df = process_data(sp, recently_played_tracks)
+    df.insert(0, "account", account)
+    if upload_lock is None:
+        upload_data(df, engine)
+    else:
+        with upload_lock:
+            upload_data(df, engine)
+
+
+def ingest_account(engine: Engine, accounts_directory: str, account: str, upload_lock: threading.Lock) -> None:
+    """ Connects to Spotify using the cached tokens of an account and ingests its recently played songs. """
+    config_path, token_cache_path = get_account_paths(accounts_directory, account)
+    sp = establish_spotify_connection(config_path, token_cache_path, headless=True, authorize=False)
+    ingest(engine, sp, account, upload_lock)
+
+
 def run(db_loc) -> None:
     """ Runs the Spotify data extraction. Establishes a connection to the Spotify API, fetches information about recently played songs, loads it into a pandas DataFrame
       and uploads that DataFrame to a local SQLite database. Returns a dataframe containing a list of the uploaded songs/artists."""
@@ -229,8 +273,47 @@ def run(db_loc) -> None:
     try:
         initialize_database(engine)
         sp = establish_spotify_connection()
-        recently_played_tracks = extract_spotify_data(sp)
-        df = process_data(sp, recently_played_tracks)
-        upload_data(df, engine)
+        ingest(engine, sp)
+    finally:
+        engine.dispose()
+
+
+def run_accounts(db_loc, accounts_directory: str, max_workers: int = 4) -> None:
+    """ Runs the Spotify data extraction for every account in the accounts directory. Accounts without cached tokens are bootstrapped one at a time first,
+      as they share the redirect URI, after which all accounts are ingested concurrently on a thread pool into the shared database. """
+    accounts = list_accounts(accounts_directory)
+    if not accounts:
+        print(f"No accounts found in {accounts_directory}.")
+        return
+
+    engine = create_engine(db_loc)
+    try:
+        initialize_database(engine)
+        for account in accounts:
+            _, token_cache_path = get_account_paths(accounts_directory, account)
+            if not os.path.isfile(token_cache_path):
+                try:
+                    bootstrap_account(accounts_directory, account)
+                except Exception as e:
+                    print(f"Bootstrapping failed for account {account}. Error : {e}")
+
+        # worker threads never authorize interactively, accounts still without cached tokens are skipped
+        authorized_accounts = []
+        for account in accounts:
+            _, token_cache_path = get_account_paths(accounts_directory, account)
+            if os.path.isfile(token_cache_path):
+                authorized_accounts.append(account)
+            else:
+                print(f"Skipping account {account}, it has no cached token.")
+
+        upload_lock = threading.Lock()
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {executor.submit(ingest_account, engine, accounts_directory, account, upload_lock): account for account in authorized_accounts}
+
+            for future in as_completed(futures):
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Extraction failed for account {futures[future]}. Error : {e}")
     finally:
         engine.dispose()
@@ -2,16 +2,55 @@ import sqlalchemy
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 import pandas as pd
+from pandas.api.types import union_categoricals
 import datetime
 from datetime import datetime
 import os
+from typing import Iterator, Optional
 
+DEFAULT_ACCOUNT = "default"  # account of single-account runs and of rows from before multi-account support
+RAW_DATA_COLUMNS = (
+    "account", "played_at", "date", "song_name", "main_artist", "featured_artists", "album_name",
+    "artist_genre", "release_date", "duration_sec", "track_id", "artist_id", "spotify_url",
+    "isrc", "mbid", "danceability", "instrumentality", "instrumentality_prob",
+    "gender", "gender_prob", "timbre", "tonality"
+)
+# timestamps that are parsed to datetime64 once at load time. They are kept as naive UTC, since Excel can't store timezone-aware datetimes.
+# date is a calendar date and stays a categorical string
+DATETIME_COLUMNS = ("played_at",)
+# probabilities don't need more than single precision
+FLOAT32_COLUMNS = ("instrumentality_prob", "gender_prob")
+INTEGER_COLUMNS = ("duration_sec",)
+# every other column is a string that repeats once per play and is stored dictionary-encoded as a category
+# raw_data is read in order of play, ties between accounts broken by account so paging is deterministic
+ORDER_BY = ("played_at", "account")
+CHUNKSIZE = 100_000
 
-def initialise_large_table(engine: Engine) -> None:
-    with engine.begin() as conn:
-        query = text(("""
+
+RAW_SPOTIFY_DATA_SCHEMA = f"""
+            CREATE TABLE IF NOT EXISTS raw_spotify_data (
+                account TEXT NOT NULL DEFAULT '{DEFAULT_ACCOUNT}', -- name of the listening account
+                played_at TEXT NOT NULL,            -- timestamp of when song was played
+                date TEXT,                          -- date of when song was played
+                song_name TEXT,                     -- song name
+                main_artist TEXT,                   -- name of artist
+                featured_artists TEXT,              -- names of featured artists, if any
+                album_name TEXT,                    -- name of song album
+                artist_genre TEXT,                         -- artist genre
+                release_date TEXT,                  -- song release date
+                duration_sec INTEGER,               -- song length
+                track_id TEXT,                      -- spotify song id
+                artist_id TEXT,                     -- spotify artist id
+                spotify_url TEXT,                   -- spotify song url
+                isrc TEXT,                          -- International Standard Recording Code
+                PRIMARY KEY (account, played_at)
+                )
+                       """
+
+RAW_DATA_SCHEMA = f"""
             CREATE TABLE IF NOT EXISTS raw_data (
-                played_at TEXT PRIMARY KEY,
+                account TEXT NOT NULL DEFAULT '{DEFAULT_ACCOUNT}',
+                played_at TEXT NOT NULL,
                 date TEXT,
                 song_name TEXT,
                 main_artist TEXT,
@@ -24,28 +63,77 @@ def initialise_large_table(engine: Engine) -> None:
                 artist_id TEXT,
                 spotify_url TEXT,
                 isrc TEXT,
-                mbid TEXT UNIQUE,
+                mbid TEXT,
                 danceability TEXT,
                 instrumentality TEXT,
                 instrumentality_prob REAL,
                 gender TEXT,
                 gender_prob REAL,
                 timbre TEXT,
-                tonality TEXT
+                tonality TEXT,
+                PRIMARY KEY (account, played_at)
             )
-        """))
-        conn.execute(query)
+        """
 
 
-def update_large_table(engine: Engine) -> None:
+def _table_columns(conn, table: str) -> list[str]:
+    return [row.name for row in conn.execute(text(f"PRAGMA table_info({table})"))]
+
+
+def _migrate_table(conn, table: str, schema: str) -> bool:
+    """ Rebuild a table created before multi-account support, keyed by played_at only, keyed by account. Also finishes a migration that was
+        interrupted after the old table was renamed. Returns whether the table was migrated. """
+    columns = _table_columns(conn, table)
+    old_columns = _table_columns(conn, f"{table}_old")
+    if columns and "account" not in columns:
+        conn.execute(text(f"ALTER TABLE {table} RENAME TO {table}_old"))
+        columns, old_columns = [], columns
+    if not old_columns:
+        return False
+
+    conn.execute(text(schema))
+    conn.execute(text(f"""
+        INSERT OR IGNORE INTO {table} (account, {", ".join(old_columns)})
+        SELECT '{DEFAULT_ACCOUNT}', {", ".join(old_columns)} FROM {table}_old
+    """))
+    conn.execute(text(f"DROP TABLE {table}_old"))
+    print(f"Migrated table {table} to multi-account layout.")
+    return True
+
+
+def migrate_to_accounts(engine: Engine) -> None:
+    """ Migrate raw_spotify_data and raw_data to the multi-account layout, and index raw_data by played_at. Runs before anything reads or writes
+        those tables. Both migrations share one transaction, so a failure leaves the database untouched, and the spotify table is migrated first
+        since the raw_data backfill reads its account column. """
+    with engine.begin() as conn:
+        # pysqlite doesn't open a transaction for DDL statements, without an explicit BEGIN every rename and create is committed immediately
+        conn.exec_driver_sql("BEGIN")
+        _migrate_table(conn, "raw_spotify_data", RAW_SPOTIFY_DATA_SCHEMA)
+        tables = {row.name for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+        if _migrate_table(conn, "raw_data", RAW_DATA_SCHEMA) and {"raw_spotify_data", "raw_acousticbrainz_data"} <= tables:
+            # the old UNIQUE constraint on mbid discarded repeat plays of a recording, recover them from the spotify table
+            insertion_count = insert_new_rows(conn, backfill=True)
+            print(f"Recovered {insertion_count} previously discarded rows in table raw_data.")
+        if _table_columns(conn, "raw_data"):
+            # the primary key starts with account, reads ordered by time need their own index
+            conn.execute(text("CREATE INDEX IF NOT EXISTS raw_data_played_at ON raw_data (played_at, account)"))
+
+
+def initialise_large_table(engine: Engine) -> None:
     with engine.begin() as conn:
+        conn.execute(text(RAW_DATA_SCHEMA))
+    migrate_to_accounts(engine)
 
-        query1 = text(""" SELECT MAX(played_at) FROM raw_data """)
-        latest = conn.execute(query1).scalar()
 
-        query2 = text(""" INSERT OR IGNORE INTO raw_data
+def insert_new_rows(conn, backfill: bool = False) -> int:
+    """ Insert plays from the spotify table, joined with their acousticbrainz data, into raw_data. Only plays newer than the latest play of each account
+        are considered, unless backfill is set. Returns the number of inserted rows. """
+    watermark = """
+                WHERE s.played_at > COALESCE(
+                    (SELECT MAX(r.played_at) FROM raw_data r WHERE r.account = s.account), '') """
+    query = text(f""" INSERT OR IGNORE INTO raw_data
                 SELECT
-                s.played_at, s.date, s.song_name, s.main_artist,
+                s.account, s.played_at, s.date, s.song_name, s.main_artist,
                 s.featured_artists, s.album_name, s.artist_genre,
                 s.release_date, s.duration_sec, s.track_id, s.artist_id,
                 s.spotify_url, s.isrc,
@@ -53,27 +141,102 @@ def update_large_table(engine: Engine) -> None:
                 a.gender, a.gender_prob,  a.timbre, a.tonality
                 FROM raw_spotify_data s
                 LEFT JOIN raw_acousticbrainz_data a ON s.isrc = a.isrc
-                WHERE :latest IS NULL or s.played_at > :latest """)
-        conn.execute(query2, {"latest": latest})
+                {"" if backfill else watermark} """)
+    conn.execute(query)
 
-        query3 = text(""" SELECT changes() """)
-        insertion_count = conn.execute(query3).scalar()
+    query2 = text(""" SELECT changes() """)
+    return conn.execute(query2).scalar()
+
+
+def update_large_table(engine: Engine) -> None:
+    with engine.begin() as conn:
+        insertion_count = insert_new_rows(conn)
         print(f"Added {insertion_count} new rows to table raw_data.")
 
 
+def _select_raw_data(columns: Optional[list[str]], where: Optional[str], order_by: Optional[tuple[str, ...]],
+                     limit: Optional[int] = None, offset: Optional[int] = None) -> tuple[list[str], str]:
+    """ Build the projected and filtered SELECT statement against raw_data. Column names are validated, the WHERE clause is expected to use bound parameters. """
+    columns = list(columns) if columns else list(RAW_DATA_COLUMNS)
+    unknown = [col for col in columns + list(order_by or ()) if col not in RAW_DATA_COLUMNS]
+    if unknown:
+        raise ValueError(f"Unknown raw_data column(s): {', '.join(unknown)}.")
+
+    query = f"SELECT {', '.join(columns)} FROM raw_data"
+    if where:
+        query += f" WHERE {where}"
+    if order_by:
+        query += f" ORDER BY {', '.join(order_by)}"
+    if limit is not None:
+        query += f" LIMIT {int(limit)} OFFSET {int(offset or 0)}"
+    return columns, query
+
+
+def _convert_dtypes(df: pd.DataFrame) -> pd.DataFrame:
+    """ Convert a chunk of raw_data from default object dtypes to compact ones. """
+    for col in df.columns:
+        if col in DATETIME_COLUMNS:
+            df[col] = pd.to_datetime(df[col], format="ISO8601", utc=True).dt.tz_localize(None)  # naive UTC
+        elif col in FLOAT32_COLUMNS:
+            df[col] = df[col].astype("float32")
+        elif col in INTEGER_COLUMNS:
+            df[col] = df[col].astype("Int32")
+        else:
+            # pin the categories to one string dtype, otherwise an all-NULL chunk gets object categories that can't be unioned with the others
+            categories = pd.Index(df[col].dropna().unique(), dtype="str")
+            df[col] = df[col].astype(pd.CategoricalDtype(categories))
+    return df
+
+
+def iter_raw_data(conn, columns: Optional[list[str]] = None, where: Optional[str] = None, params: Optional[dict] = None,
+                  order_by: Optional[tuple[str, ...]] = ORDER_BY, limit: Optional[int] = None, offset: Optional[int] = None,
+                  chunksize: int = CHUNKSIZE) -> Iterator[pd.DataFrame]:
+    """ Read raw_data in chunks of at most chunksize rows. Only the requested columns and rows matching the WHERE clause are read from the database,
+        and each chunk is converted to compact dtypes (see _convert_dtypes) before it is yielded. """
+    _, query = _select_raw_data(columns, where, order_by, limit, offset)
+    for chunk in pd.read_sql(text(query), conn, params=params or {}, chunksize=chunksize):
+        yield _convert_dtypes(chunk)
+
+
+def load_raw_data(conn, columns: Optional[list[str]] = None, where: Optional[str] = None, params: Optional[dict] = None,
+                  order_by: Optional[tuple[str, ...]] = ORDER_BY, limit: Optional[int] = None, offset: Optional[int] = None,
+                  chunksize: int = CHUNKSIZE, verbose: bool = True) -> pd.DataFrame:
+    """ Shared loader for raw_data, used by all analyses and exports. Reads the table chunk by chunk through iter_raw_data and combines the chunks,
+        unifying the categories of each categorical column so they stay dictionary-encoded. If verbose, prints the memory footprint of the loaded DataFrame. """
+    columns, _ = _select_raw_data(columns, where, order_by, limit, offset)
+    chunks = list(iter_raw_data(conn, columns, where, params, order_by, limit, offset, chunksize))
+
+    if not chunks:
+        df = _convert_dtypes(pd.DataFrame({col: pd.Series(dtype="object") for col in columns}))
+    elif len(chunks) == 1:
+        df = chunks[0]
+    else:
+        data = {}
+        for col in columns:
+            parts = [chunk[col] for chunk in chunks]
+            if isinstance(parts[0].dtype, pd.CategoricalDtype):
+                data[col] = union_categoricals(parts)
+            else:
+                data[col] = pd.concat(parts, ignore_index=True)
+        df = pd.DataFrame(data)
+
+    if verbose:
+        memory_mb = df.memory_usage(deep=True).sum() / 1024 ** 2
+        print(f"Loaded {len(df.index)} rows and {len(df.columns)} columns from raw_data, using {memory_mb:.1f} MB of memory.")
+    return df
+
+
 def template_db_query(db_loc: str, output_directory: str = "./exports") -> str:
     os.makedirs(output_directory, exist_ok=True)
     engine = create_engine(db_loc)
+    migrate_to_accounts(engine)
     with engine.begin() as conn:
 
         # get data
-        query = text("""
-        SELECT
-        FROM raw_data
-        WHERE
-        ORDER BY
-    """)
-        df = pd.read_sql(query, conn)
+        df = load_raw_data(conn,
+                           columns=None,  # e.g. ["played_at", "danceability"]
+                           where=None,    # e.g. "danceability IS NOT NULL AND date >= :start"
+                           params={})
 
         # transform
         # df[''] = df[''].round(2)
@@ -87,58 +250,60 @@ def template_db_query(db_loc: str, output_directory: str = "./exports") -> str:
     engine.dispose()
 
 
+def hourly_data(conn, verbose: bool = True) -> pd.DataFrame:
+    """ Aggregate raw_data by hour of day: average danceability, brightness and male scores, most common genre and number of entries. """
+    query_hourly = text("""
+    SELECT
+        CAST(strftime('%H', datetime(played_at)) AS INTEGER) AS hour_of_day,
+        ROUND(AVG(CASE
+                    WHEN danceability = 'danceable' THEN 1
+                    WHEN danceability = 'not_danceable' THEN 0
+                    ELSE 0.5
+                END), 2) AS danceability_score,
+        ROUND(AVG(CASE
+                    WHEN timbre = 'bright' THEN 1
+                    WHEN timbre = 'dark' then 0
+                    ELSE 0.5
+                END), 2) AS brightness_score,
+        ROUND(AVG(CASE
+                    WHEN gender = 'male' THEN gender_prob
+                    WHEN gender = 'female' then -gender_prob
+                    ELSE 0
+                END), 2) AS male_score,
+        COUNT(*) as entries
+    FROM raw_data
+    WHERE danceability IS NOT NULL
+    AND timbre IS NOT NULL
+    GROUP BY hour_of_day
+    ORDER BY hour_of_day
+    """)
+
+    df_hourly = pd.read_sql(query_hourly, conn)
+    df_genres = load_raw_data(conn, columns=["played_at", "artist_genre"], where="artist_genre != ''", order_by=None, verbose=verbose)
+    df_genres['artist_genre'] = df_genres['artist_genre'].str.split(',\\s*')
+    exploded_df = df_genres.explode('artist_genre')
+    exploded_df['hour'] = exploded_df['played_at'].dt.hour
+    genre_counts = exploded_df.groupby(['hour', 'artist_genre']).size().reset_index(name='count')
+    most_common_genres = genre_counts.loc[genre_counts.groupby('hour')['count'].idxmax()]
+    most_common_genres = most_common_genres.rename(columns={'artist_genre': 'most_common_genre'})
+
+    df_final = df_hourly.merge(
+        most_common_genres[['hour', 'most_common_genre']],
+        left_on='hour_of_day',
+        right_on='hour',
+        how='left'
+    )
+    df_final = df_final[['hour_of_day', 'brightness_score', 'danceability_score', 'most_common_genre', 'male_score', 'entries']]
+    df_final['hour_of_day'] = df_final['hour_of_day'] + 2 % 24  # from ISO8601 to CET
+    return df_final
+
+
 def create_hourly_sheet(db_loc: str, output_directory: str = "./exports") -> None:
     os.makedirs(output_directory, exist_ok=True)
     engine = create_engine(db_loc)
+    migrate_to_accounts(engine)
     with engine.begin() as conn:
-        query_hourly = text("""
-        SELECT
-            CAST(strftime('%H', datetime(played_at)) AS INTEGER) AS hour_of_day,
-            ROUND(AVG(CASE
-                        WHEN danceability = 'danceable' THEN 1
-                        WHEN danceability = 'not_danceable' THEN 0
-                        ELSE 0.5
-                    END), 2) AS danceability_score,
-            ROUND(AVG(CASE
-                        WHEN timbre = 'bright' THEN 1
-                        WHEN timbre = 'dark' then 0
-                        ELSE 0.5
-                    END), 2) AS brightness_score,
-            ROUND(AVG(CASE
-                        WHEN gender = 'male' THEN gender_prob
-                        WHEN gender = 'female' then -gender_prob
-                        ELSE 0
-                    END), 2) AS male_score,
-            COUNT(*) as entries
-        FROM raw_data
-        WHERE danceability IS NOT NULL
-        AND timbre IS NOT NULL
-        GROUP BY hour_of_day
-        ORDER BY hour_of_day
-        """)
-
-        df_hourly = pd.read_sql(query_hourly, conn)
-        query_genres = text("""
-        SELECT played_at, artist_genre
-        FROM raw_data
-        WHERE artist_genre != ''
-        """)
-        df_genres = pd.read_sql(query_genres, conn)
-        df_genres['artist_genre'] = df_genres['artist_genre'].str.split(',\\s*')
-        exploded_df = df_genres.explode('artist_genre')
-        exploded_df['hour'] = pd.to_datetime(exploded_df['played_at']).dt.hour
-        genre_counts = exploded_df.groupby(['hour', 'artist_genre']).size().reset_index(name='count')
-        most_common_genres = genre_counts.loc[genre_counts.groupby('hour')['count'].idxmax()]
-        most_common_genres = most_common_genres.rename(columns={'artist_genre': 'most_common_genre'})
-
-        df_final = df_hourly.merge(
-            most_common_genres[['hour', 'most_common_genre']],
-            left_on='hour_of_day',
-            right_on='hour',
-            how='left'
-        )
-        df_final = df_final[['hour_of_day', 'brightness_score', 'danceability_score', 'most_common_genre', 'male_score', 'entries']]
-        df_final['hour_of_day'] = df_final['hour_of_day'] + 2 % 24  # from ISO8601 to CET
+        df_final = hourly_data(conn)
         current_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         table_name = "data_by_hour"
         output_path = f"{output_directory}/{table_name}_{current_timestamp}.xlsx"
@@ -148,15 +313,11 @@ def create_hourly_sheet(db_loc: str, output_directory: str = "./exports") -> Non
 def create_large_sheet(db_loc: str, output_directory: str = "./exports") -> None:
     os.makedirs(output_directory, exist_ok=True)
     engine = create_engine(db_loc)
+    migrate_to_accounts(engine)
     with engine.begin() as conn:
 
         # get data
-        query = text("""
-        SELECT *
-        FROM raw_data
-        ORDER BY played_at ASC
-        """)
-        df = pd.read_sql(query, conn)
+        df = load_raw_data(conn)
         current_timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
         table_name = "large_sheet"  # "features_by_day","features_by_hour" "genre_analysis"
         output_path = f"{output_directory}/{table_name}_{current_timestamp}.xlsx"
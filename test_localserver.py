@@ -0,0 +1,163 @@
+import json
+import threading
+import time
+import urllib.error
+import urllib.request
+
+import pytest
+from sqlalchemy import create_engine, text
+
+import localserver
+import sql_operations
+
+
+def test_response_cache_drops_entries_rendered_against_outdated_version():
+    """ A response rendered before a pipeline commit must not be cached after the commit cleared the cache. """
+    cache = localserver.ResponseCache()
+    cache.validate(1)
+    cache.validate(2)
+    cache.put("/hourly", ('"etag"', "application/json", b"[]"), 1)
+    assert cache.get("/hourly") is None
+
+
+def test_response_cache_is_limited_by_body_size():
+    cache = localserver.ResponseCache(max_bytes=10)
+    cache.validate(1)
+    cache.put("/date/2024-01-01", ('"a"', "application/json", b"123456"), 1)
+    cache.put("/date/2024-01-02", ('"b"', "application/json", b"123456"), 1)
+    cache.put("/large", ('"c"', "application/json", b"12345678901"), 1)
+    assert cache.get("/date/2024-01-01") is None
+    assert cache.get("/date/2024-01-02") is not None
+    assert cache.get("/large") is None
+    assert cache.size == 6
+
+
+def insert_play(engine, played_at: str, account: str = sql_operations.DEFAULT_ACCOUNT) -> None:
+    with engine.begin() as conn:
+        conn.execute(text("""
+            INSERT INTO raw_data (account, played_at, date, artist_genre, danceability, timbre, gender, gender_prob)
+            VALUES (:account, :played_at, :date, 'pop, rock', 'danceable', 'bright', 'male', 0.9)
+        """), {"account": account, "played_at": played_at, "date": played_at[:10]})
+
+
+@pytest.fixture
+def server(tmp_path):
+    """ Query server on a free port, serving a temporary database with five plays on 2024-01-04 and one on 2024-01-05. """
+    db_loc = f"sqlite:///{tmp_path / 'tracks.sqlite'}"
+    engine = create_engine(db_loc)
+    sql_operations.initialise_large_table(engine)
+    for hour in range(10, 15):
+        insert_play(engine, f"2024-01-04T{hour}:00:00.000Z")
+    insert_play(engine, "2024-01-05T09:30:00.000Z", account="bob")
+
+    httpd = localserver.QueryServer(("127.0.0.1", 0), db_loc)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    yield httpd, engine
+    httpd.shutdown()
+    httpd.server_close()
+    engine.dispose()
+
+
+def get(httpd, path: str, etag: str = None) -> tuple[int, dict, bytes]:
+    request = urllib.request.Request(f"http://127.0.0.1:{httpd.server_address[1]}{path}", headers={"If-None-Match": etag} if etag else {})
+    try:
+        with urllib.request.urlopen(request) as response:
+            return response.status, dict(response.headers), response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, dict(e.headers), e.read()
+
+
+def test_query_server_rejects_in_memory_database():
+    with pytest.raises(ValueError):
+        localserver.QueryServer(("127.0.0.1", 0), "sqlite://")
+
+
+def test_unchanged_refresh_is_answered_with_304(server):
+    httpd, _ = server
+    status, headers, body = get(httpd, "/hourly")
+    assert status == 200
+    assert sum(row["entries"] for row in json.loads(body)) == 6
+
+    status, _, body = get(httpd, "/hourly", headers["ETag"])
+    assert status == 304
+    assert body == b""
+
+
+def test_commit_invalidates_cached_responses(server):
+    httpd, engine = server
+    _, headers, _ = get(httpd, "/date/2024-01-04")
+    time.sleep(0.05)
+    insert_play(engine, "2024-01-04T20:00:00.000Z")
+
+    status, new_headers, body = get(httpd, "/date/2024-01-04", headers["ETag"])
+    assert status == 200
+    assert new_headers["ETag"] != headers["ETag"]
+    assert len(json.loads(body)) == 6
+
+
+def test_date_slice_serializes_like_spotify(server):
+    httpd, _ = server
+    status, _, body = get(httpd, "/date/2024-01-05")
+    assert status == 200
+    [row] = json.loads(body)
+    assert row["account"] == "bob"
+    assert row["played_at"] == "2024-01-05T09:30:00.000Z"
+    assert row["date"] == "2024-01-05"
+    assert row["gender_prob"] == 0.9
+
+
+def test_large_table_pages(server):
+    httpd, _ = server
+    status, _, body = get(httpd, "/large?page=2&page_size=2")
+    assert status == 200
+    page = json.loads(body)
+    assert [row["played_at"] for row in page["rows"]] == ["2024-01-04T12:00:00.000Z", "2024-01-04T13:00:00.000Z"]
+
+    status, _, body = get(httpd, "/large?page=4&page_size=2")
+    assert status == 200
+    assert json.loads(body)["rows"] == []
+
+
+@pytest.mark.parametrize("path", [
+    "/large?page=0",
+    f"/large?page_size={localserver.MAX_PAGE_SIZE + 1}",
+    "/large?page=one",
+    "/large?format=xml",
+    "/date/2024-13-01",
+])
+def test_invalid_requests_are_answered_with_400(server, path):
+    httpd, _ = server
+    assert get(httpd, path)[0] == 400
+
+
+def test_unknown_endpoint_is_answered_with_404(server):
+    httpd, _ = server
+    assert get(httpd, "/tracks")[0] == 404
+
+
+def test_streams_use_same_serialization_as_json(server):
+    httpd, _ = server
+    status, headers, body = get(httpd, "/large?format=ndjson")
+    assert status == 200
+    rows = [json.loads(line) for line in body.decode().splitlines()]
+    assert len(rows) == 6
+    assert rows[0]["played_at"] == "2024-01-04T10:00:00.000Z"
+    assert rows[0]["gender_prob"] == 0.9
+    assert get(httpd, "/large?format=ndjson", headers["ETag"])[0] == 304
+
+    status, _, body = get(httpd, "/large?format=csv")
+    assert status == 200
+    lines = body.decode().splitlines()
+    assert lines[0].startswith("account,played_at,date,")
+    assert len(lines) == 7
+    assert lines[1].startswith("default,2024-01-04T10:00:00.000Z,2024-01-04,")
+    assert ",0.9," in lines[1]
+
+
+def test_database_errors_are_answered_with_500(server):
+    httpd, engine = server
+    with engine.begin() as conn:
+        conn.execute(text("DROP TABLE raw_data"))
+    assert get(httpd, "/date/2024-01-04")[0] == 500
+    assert get(httpd, "/large?format=csv")[0] == 500
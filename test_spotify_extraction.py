@@ -0,0 +1,22 @@
+import pandas as pd
+import pytest
+
+import spotify_extraction
+
+
+def test_validate_data_allows_same_timestamp_for_different_accounts():
+    df = pd.DataFrame({"account": ["alice", "bob"], "played_at": ["2024-01-01T10:00:00.000Z"] * 2})
+    assert spotify_extraction.validate_data(df)
+
+
+def test_validate_data_rejects_duplicate_plays_of_one_account():
+    df = pd.DataFrame({"account": ["alice", "alice"], "played_at": ["2024-01-01T10:00:00.000Z"] * 2})
+    with pytest.raises(Exception, match="Primary key is not unique"):
+        spotify_extraction.validate_data(df)
+
+
+def test_establish_spotify_connection_without_authorize_requires_cached_token(tmp_path):
+    config_path = tmp_path / "spotify_config.txt"
+    config_path.write_text("client id\nclient secret\nhttp://127.0.0.1:8888/callback\n")
+    with pytest.raises(RuntimeError, match="bootstrapped"):
+        spotify_extraction.establish_spotify_connection(str(config_path), str(tmp_path / "missing_cache.json"), headless=True, authorize=False)
@@ -0,0 +1,146 @@
+import pandas as pd
+from sqlalchemy import create_engine, text
+
+import sql_operations
+
+
+def test_load_raw_data_mixes_null_and_enriched_chunks():
+    """ An older history that AcousticBrainz never enriched has chunks where mbid/danceability are entirely NULL. """
+    engine = create_engine("sqlite://")
+    sql_operations.initialise_large_table(engine)
+    with engine.begin() as conn:
+        for i in range(10):
+            enriched = i >= 5
+            conn.execute(text("""
+                INSERT INTO raw_data (played_at, date, song_name, main_artist, mbid, danceability, gender_prob)
+                VALUES (:played_at, :date, :song_name, 'artist', :mbid, :danceability, :gender_prob)
+            """), {
+                "played_at": f"2024-01-0{i // 5 + 1}T12:0{i}:00.000Z",
+                "date": f"2024-01-0{i // 5 + 1}",
+                "song_name": f"song {i % 3}",
+                "mbid": f"mbid-{i}" if enriched else None,
+                "danceability": "danceable" if enriched else None,
+                "gender_prob": 0.5 if enriched else None,
+            })
+
+    with engine.connect() as conn:
+        df = sql_operations.load_raw_data(conn, chunksize=5)
+
+    assert len(df.index) == 10
+    assert isinstance(df["mbid"].dtype, pd.CategoricalDtype)
+    assert isinstance(df["danceability"].dtype, pd.CategoricalDtype)
+    assert df["mbid"].isna().sum() == 5
+    assert list(df["danceability"].cat.categories) == ["danceable"]
+    assert df["played_at"].dtype.kind == "M"
+    assert df["played_at"].iloc[0] == pd.Timestamp("2024-01-01 12:00:00")
+    assert isinstance(df["date"].dtype, pd.CategoricalDtype)
+    assert list(df["date"].cat.categories) == ["2024-01-01", "2024-01-02"]
+    assert df["gender_prob"].dtype == "float32"
+    engine.dispose()
+
+
+BASELINE_SCHEMA = [
+    """ CREATE TABLE raw_spotify_data (
+        played_at TEXT PRIMARY KEY, date TEXT, song_name TEXT, main_artist TEXT, featured_artists TEXT, album_name TEXT, artist_genre TEXT,
+        release_date TEXT, duration_sec INTEGER, track_id TEXT, artist_id TEXT, spotify_url TEXT, isrc TEXT) """,
+    """ CREATE TABLE raw_acousticbrainz_data (
+        isrc TEXT PRIMARY KEY NOT NULL, mbid TEXT UNIQUE, danceability TEXT, instrumentality TEXT, instrumentality_prob REAL,
+        gender TEXT, gender_prob REAL, timbre TEXT, tonality TEXT) """,
+    """ CREATE TABLE raw_data (
+        played_at TEXT PRIMARY KEY, date TEXT, song_name TEXT, main_artist TEXT, featured_artists TEXT, album_name TEXT, artist_genre TEXT,
+        release_date TEXT, duration_sec INTEGER, track_id TEXT, artist_id TEXT, spotify_url TEXT, isrc TEXT, mbid TEXT UNIQUE,
+        danceability TEXT, instrumentality TEXT, instrumentality_prob REAL, gender TEXT, gender_prob REAL, timbre TEXT, tonality TEXT) """,
+]
+
+
+def create_baseline_database(db_loc: str) -> None:
+    """ A database from before multi-account support, where the UNIQUE constraint on mbid discarded two repeat plays of the same recording. """
+    engine = create_engine(db_loc)
+    with engine.begin() as conn:
+        for query in BASELINE_SCHEMA:
+            conn.execute(text(query))
+        for played_at in ("2024-01-01T10:00:00.000Z", "2024-01-01T11:00:00.000Z", "2024-01-01T12:00:00.000Z"):
+            conn.execute(text("INSERT INTO raw_spotify_data (played_at, date, isrc) VALUES (:played_at, '2024-01-01', 'ISRC1')"),
+                         {"played_at": played_at})
+        conn.execute(text("INSERT INTO raw_acousticbrainz_data (isrc, mbid) VALUES ('ISRC1', 'MBID1')"))
+        conn.execute(text("INSERT INTO raw_data (played_at, date, isrc, mbid) VALUES ('2024-01-01T10:00:00.000Z', '2024-01-01', 'ISRC1', 'MBID1')"))
+    engine.dispose()
+
+
+def table_names(conn) -> set[str]:
+    return {row.name for row in conn.execute(text("SELECT name FROM sqlite_master WHERE type = 'table'"))}
+
+
+def test_run_migrates_baseline_database_and_backfills_discarded_rows(tmp_path):
+    db_loc = f"sqlite:///{tmp_path / 'tracks.sqlite'}"
+    create_baseline_database(db_loc)
+
+    sql_operations.run(db_loc)
+
+    engine = create_engine(db_loc)
+    with engine.connect() as conn:
+        assert table_names(conn) == {"raw_spotify_data", "raw_acousticbrainz_data", "raw_data"}
+        assert "account" in sql_operations._table_columns(conn, "raw_spotify_data")
+        rows = conn.execute(text("SELECT account, played_at, mbid FROM raw_data ORDER BY played_at")).fetchall()
+        assert [(row.account, row.mbid) for row in rows] == [(sql_operations.DEFAULT_ACCOUNT, "MBID1")] * 3
+        plan = " ".join(row.detail for row in conn.execute(text("EXPLAIN QUERY PLAN SELECT * FROM raw_data ORDER BY played_at, account LIMIT 10")))
+        assert "raw_data_played_at" in plan
+        assert "TEMP B-TREE" not in plan
+    engine.dispose()
+
+
+def test_failed_migration_leaves_database_untouched(tmp_path, monkeypatch):
+    db_loc = f"sqlite:///{tmp_path / 'tracks.sqlite'}"
+    create_baseline_database(db_loc)
+
+    def fail(conn, backfill=False):
+        raise RuntimeError("backfill failed")
+    monkeypatch.setattr(sql_operations, "insert_new_rows", fail)
+
+    engine = create_engine(db_loc)
+    try:
+        sql_operations.migrate_to_accounts(engine)
+    except RuntimeError:
+        pass
+    with engine.connect() as conn:
+        assert table_names(conn) == {"raw_spotify_data", "raw_acousticbrainz_data", "raw_data"}
+        assert "account" not in sql_operations._table_columns(conn, "raw_spotify_data")
+        assert "account" not in sql_operations._table_columns(conn, "raw_data")
+    engine.dispose()
+
+
+def test_exports_migrate_baseline_database(tmp_path):
+    db_loc = f"sqlite:///{tmp_path / 'tracks.sqlite'}"
+    create_baseline_database(db_loc)
+
+    sql_operations.create_large_sheet(db_loc, str(tmp_path / "exports"))
+
+    exports = list((tmp_path / "exports").iterdir())
+    assert len(exports) == 1
+    assert len(pd.read_excel(exports[0]).index) == 3
+
+
+def test_update_large_table_uses_per_account_watermark():
+    engine = create_engine("sqlite://")
+    with engine.begin() as conn:
+        conn.execute(text(sql_operations.RAW_SPOTIFY_DATA_SCHEMA))
+        conn.execute(text(BASELINE_SCHEMA[1]))
+    sql_operations.initialise_large_table(engine)
+
+    def play(account: str, played_at: str) -> None:
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO raw_spotify_data (account, played_at) VALUES (:account, :played_at)"),
+                         {"account": account, "played_at": played_at})
+
+    play("alice", "2024-01-01T10:00:00.000Z")
+    play("alice", "2024-01-01T12:00:00.000Z")
+    sql_operations.update_large_table(engine)
+
+    # bob's play is older than alice's latest play, but newer than bob's own latest
+    play("bob", "2024-01-01T11:00:00.000Z")
+    play("alice", "2024-01-01T13:00:00.000Z")
+    with engine.begin() as conn:
+        assert sql_operations.insert_new_rows(conn) == 2
+        rows = conn.execute(text("SELECT account, played_at FROM raw_data ORDER BY played_at, account")).fetchall()
+    assert [row.account for row in rows] == ["alice", "bob", "alice", "alice"]
+    engine.dispose()